@@ -14,8 +14,10 @@ WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
 from ._version import __version__, version_info
 from .events import MusicEvents
 from .music import Music
+from .presence import MusicPresence
 
 
 def setup(bot):
     bot.add_cog(Music(bot))
     bot.add_cog(MusicEvents(bot))
+    bot.add_cog(MusicPresence(bot))
@@ -0,0 +1,68 @@
+import re
+import time
+
+import aiohttp
+
+TRACK_URL = re.compile(r"(?:open\.spotify\.com/track/|spotify:track:)([A-Za-z0-9]+)")
+
+
+class SpotifyResolver:
+    """Looks up Spotify track names ourselves, so the YouTube search runs on a node we picked.
+
+    wavelink's Spotify client searches YouTube on whatever `NodePool.get_node()` returns,
+    ignoring node roles and nodes marked down.
+    """
+
+    def __init__(self, client_id: str, client_secret: str) -> None:
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.session = None
+        self.token = None
+        self.expires = 0.0
+        self.names = {}
+
+    def can_resolve(self, query: str) -> bool:
+        return bool(self.client_id and self.client_secret and TRACK_URL.search(query))
+
+    async def get_token(self) -> str:
+        if self.token and time.monotonic() < self.expires:
+            return self.token
+
+        if not self.session:
+            self.session = aiohttp.ClientSession()
+
+        async with self.session.post(
+            "https://accounts.spotify.com/api/token",
+            data={"grant_type": "client_credentials"},
+            auth=aiohttp.BasicAuth(self.client_id, self.client_secret),
+        ) as response:
+            response.raise_for_status()
+            data = await response.json()
+
+        self.token = data["access_token"]
+        self.expires = time.monotonic() + data["expires_in"] - 60
+        return self.token
+
+    async def get_name(self, track_id: str) -> str:
+        if track_id in self.names:
+            return self.names[track_id]
+
+        headers = {"Authorization": f"Bearer {await self.get_token()}"}
+        async with self.session.get(f"https://api.spotify.com/v1/tracks/{track_id}", headers=headers) as response:
+            response.raise_for_status()
+            data = await response.json()
+
+        if len(self.names) > 1000:
+            self.names.clear()
+
+        self.names[track_id] = f"{data['name']} - {data['artists'][0]['name']}"
+        return self.names[track_id]
+
+    async def resolve(self, query: str) -> str:
+        """YouTube search query for a Spotify track link"""
+        return await self.get_name(TRACK_URL.search(query).group(1))
+
+    async def close(self) -> None:
+        if self.session:
+            await self.session.close()
+            self.session = None
@@ -35,3 +35,9 @@ class InvalidLoopMode(CheckFailure):
     """Invalid loop mode"""
 
     pass
+
+
+class PlayerInOtherProcess(CheckFailure):
+    """Another dismusic process already plays in this guild"""
+
+    pass
@@ -7,9 +7,12 @@ from .errors import (
     NotConnectedToVoice,
     NotEnoughSong,
     NothingIsPlaying,
+    PlayerInOtherProcess,
     PlayerNotConnected,
 )
+from .outbox import get_outbox
 from .player import DisPlayer
+from .tracing import tracer
 
 
 class MusicEvents(commands.Cog):
@@ -17,14 +20,20 @@ class MusicEvents(commands.Cog):
         self.bot = bot
 
     async def handle_end_stuck_exception(self, player: DisPlayer, track: wavelink.abc.Playable):
-        if player.loop == "當前歌曲":
-            return await player.play(track)
+        # Destroyed players still get the end event for the track they were stopped on
+        if player.queue is None:
+            return
 
-        if player.loop == "播放列表":
-            await player.queue.put(track)
+        with tracer.span("handle_end_stuck_exception", guild=player.guild.id, node=player.node.identifier):
+            if player.loop == "當前歌曲":
+                await player.apply_pending_move()
+                return await player.play(track)
 
-        player._source = None
-        await player.do_next()
+            if player.loop == "播放列表":
+                await player.queue.put(track)
+
+            player._source = None
+            await player.do_next()
 
     @commands.Cog.listener()
     async def on_wavelink_track_end(self, player, track, *args, **kwargs):
@@ -48,11 +57,12 @@ class MusicEvents(commands.Cog):
             MustBeSameChannel,
             NotConnectedToVoice,
             PlayerNotConnected,
+            PlayerInOtherProcess,
             NothingIsPlaying,
             NotEnoughSong,
         )
 
         if isinstance(error, errors):
-            await ctx.send(error)
+            await get_outbox(self.bot).send(ctx.channel, str(error))
         else:
             pass
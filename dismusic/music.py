@@ -1,5 +1,8 @@
 import asyncio
+import os
+import time
 
+import aiohttp
 import async_timeout
 import wavelink
 from discord import ClientException, ApplicationContext, Member, Message, message_command, user_command
@@ -16,10 +19,16 @@ from wavelink.ext import spotify
 from wavelink.ext.spotify import SpotifyTrack
 
 from ._classes import Provider
+from ._spotify import SpotifyResolver
 from .checks import voice_channel_player, voice_connected
-from .errors import MustBeSameChannel
+from .errors import MustBeSameChannel, PlayerInOtherProcess
+from .nodes import ROLES, get_nodes, metrics, node_role, node_roles, player_cls
+from .outbox import get_outbox
 from .paginator import Paginator
 from .player import DisPlayer
+from .rebalancer import NodeRebalancer
+from .state import SharedState
+from .tracing import tracer
 
 
 class Music(commands.Cog):
@@ -27,17 +36,57 @@ class Music(commands.Cog):
 
     def __init__(self, bot):
         self.bot: commands.Bot = bot
-        self.bot.loop.create_task(self.start_nodes())
-
-    def get_nodes(self):
-        return sorted(wavelink.NodePool._nodes.values(), key=lambda n: len(n.players))
+        self.outbox = get_outbox(bot)
+        self.rebalancer = NodeRebalancer(bot)
+        self.state = SharedState(bot)
+        self.spotify = SpotifyResolver(
+            **getattr(self.bot, "spotify_credentials", {"client_id": "", "client_secret": ""})
+        )
+        self.tasks = [
+            self.bot.loop.create_task(self.start_nodes()),
+            self.bot.loop.create_task(self.rebalancer.run()),
+            self.bot.loop.create_task(self.state.run()),
+        ]
+
+    def get_nodes(self, role: str = None):
+        return get_nodes(role)
+
+    def cog_unload(self) -> None:
+        # Otherwise a reloaded cog runs a second rebalancer and state sync next to the new ones
+        for task in self.tasks:
+            task.cancel()
+
+        self.bot.loop.create_task(self.state.backend.close())
+        self.bot.loop.create_task(tracer.close())
+        self.bot.loop.create_task(self.spotify.close())
+
+    async def cog_check(self, ctx) -> bool:
+        # can_run also calls this outside of an invocation, e.g. when help filters commands
+        if ctx.command and ctx.command.cog is self and not hasattr(ctx, "dismusic_span"):
+            ctx.dismusic_span = tracer.start_span(
+                ctx.command.qualified_name, guild=ctx.guild.id if ctx.guild else None
+            )
+
+        return True
+
+    async def cog_after_invoke(self, ctx) -> None:
+        span = getattr(ctx, "dismusic_span", None)
+
+        if not getattr(ctx, "command_failed", False):
+            return tracer.end_span(span)
+
+        # Failed commands are closed in cog_command_error so the span carries the error.
+        # Cancelled ones never get there, so close them shortly after regardless.
+        self.bot.loop.call_later(5, tracer.end_span, span, None, time.time_ns())
+
+    async def cog_command_error(self, ctx, error) -> None:
+        tracer.end_span(getattr(ctx, "dismusic_span", None), error)
 
     async def play_track(self, ctx: commands.Context, query: str, provider=None):
-        player: DisPlayer = ctx.voice_client
-
-        if ctx.author.voice.channel.id != player.channel.id:
-            raise MustBeSameChannel("你跟偶不在同個頻率上 嘖嘖")
+        with tracer.span("play_track", guild=ctx.guild.id, provider=provider):
+            await self._play_track(ctx, query, provider)
 
+    def get_provider(self, query: str, provider: str = None, player: DisPlayer = None) -> Provider:
         track_providers = {
             "yt": YouTubeTrack,
             "ytpl": YouTubePlaylist,
@@ -46,62 +95,170 @@ class Music(commands.Cog):
             "spotify": SpotifyTrack,
         }
 
-        query = query.strip("<>")
-        msg = await ctx.send(f"搜尋 `{query}` :mag_right:")
-
         track_provider = provider if provider else player.track_provider
 
         if track_provider == "yt" and "playlist" in query:
             provider = "ytpl"
 
-        provider: Provider = track_providers.get(provider) if provider else track_providers.get(player.track_provider)
+        return track_providers.get(provider) if provider else track_providers.get(player.track_provider)
 
-        nodes = self.get_nodes()
+    async def search_tracks(self, query: str, provider: Provider, nodes=None) -> list:
+        """Search nodes in order until one answers; returns the tracks to enqueue"""
+        with tracer.span("search.cache", provider=provider.__name__) as span:
+            cached = await self.state.get_search(provider.__name__, query)
+            span.set_attribute("hit", cached is not None)
+
+        if cached is not None:
+            return cached
+
+        nodes = nodes or self.get_nodes("search")
 
         tracks = list()
 
-        for node in nodes:
-            try:
-                with async_timeout.timeout(20):
-                    tracks = await provider.search(query, node=node)
+        # Looked up before the node timeout, so a slow Spotify API can't get a node marked down
+        spotify_query = None
+        if provider is SpotifyTrack and self.spotify.can_resolve(query):
+            with tracer.span("search.spotify") as span:
+                try:
+                    with async_timeout.timeout(10):
+                        spotify_query = await self.spotify.resolve(query)
+                except (asyncio.TimeoutError, aiohttp.ClientError) as e:
+                    span.set_attribute("outcome", "spotify_error")
+                    print(f"[dismusic] ERROR - Spotify lookup failed: {e!r}")
+                    return tracks
+
+        with tracer.span("search", provider=provider.__name__):
+            for node in nodes:
+                with tracer.span("search.node", node=node.identifier, role=node_role(node)) as span:
+                    started = time.perf_counter()
+                    try:
+                        with async_timeout.timeout(20):
+                            if spotify_query:
+                                tracks = await YouTubeTrack.search(spotify_query, node=node)
+                            else:
+                                tracks = await provider.search(query, node=node)
+                    except asyncio.TimeoutError:
+                        span.set_attribute("outcome", "timeout")
+                        metrics.record_search(node, time.perf_counter() - started, ok=False)
+                        self.bot.dispatch("dismusic_node_fail", node)
+                        wavelink.NodePool._nodes.pop(node.identifier, None)
+                        await self.state.mark_node_down(node)
+                        continue
+                    except (LavalinkException, LoadTrackError):
+                        span.set_attribute("outcome", "error")
+                        metrics.record_search(node, time.perf_counter() - started, ok=False)
+                        continue
+                    except aiohttp.ClientError as e:
+                        # Spotify itself failed; another node won't help
+                        span.set_attribute("outcome", "spotify_error")
+                        print(f"[dismusic] ERROR - Spotify lookup failed: {e}")
+                        break
+
+                    metrics.record_search(node, time.perf_counter() - started, ok=True)
                     break
-            except asyncio.TimeoutError:
-                self.bot.dispatch("dismusic_node_fail", node)
-                wavelink.NodePool._nodes.pop(node.identifier)
-                continue
-            except (LavalinkException, LoadTrackError):
-                continue
+
+        tracks = tracks.tracks if isinstance(tracks, YouTubePlaylist) else tracks[:1]
+        await self.state.put_search(provider.__name__, query, tracks)
+
+        return tracks
+
+    async def _play_track(self, ctx: commands.Context, query: str, provider=None):
+        player: DisPlayer = ctx.voice_client
+
+        if ctx.author.voice.channel.id != player.channel.id:
+            raise MustBeSameChannel("你跟偶不在同個頻率上 嘖嘖")
+
+        query = query.strip("<>")
+        msg = await self.outbox.send(ctx.channel, f"搜尋 `{query}` :mag_right:")
+
+        tracks = await self.search_tracks(query, self.get_provider(query, provider, player))
 
         if not tracks:
             return await msg.edit("找不到指定的歌曲或播放清單")
 
-        if isinstance(tracks, YouTubePlaylist):
-            tracks = tracks.tracks
+        with tracer.span("enqueue", tracks=len(tracks)):
             for track in tracks:
                 await player.queue.put(track)
 
+        if len(tracks) > 1:
             await msg.edit(content=f"增加 `{len(tracks)}` 首到播放列")
         else:
-            track = tracks[0]
-
-            await msg.edit(content=f"增加 `{track.title}` 到播放列")
-            await player.queue.put(track)
+            await msg.edit(content=f"增加 `{tracks[0].title}` 到播放列")
 
         if not player.is_playing():
             await player.do_next()
 
+    async def play_batch(self, ctx: commands.Context, queries: str, provider=None):
+        player: DisPlayer = ctx.voice_client
+
+        if ctx.author.voice.channel.id != player.channel.id:
+            raise MustBeSameChannel("你跟偶不在同個頻率上 嘖嘖")
+
+        lines = queries.splitlines()
+        for attachment in getattr(ctx.message, "attachments", []):
+            if attachment.filename.endswith(".txt"):
+                lines.extend((await attachment.read()).decode("utf-8", "ignore").splitlines())
+
+        queries = [line.strip().strip("<>") for line in lines if line.strip()]
+        limit = int(os.getenv("DISMUSIC_BATCH_LIMIT", 50))
+
+        if not queries:
+            return await self.outbox.send(ctx.channel, "沒有要播放的歌曲")
+
+        if len(queries) > limit:
+            return await self.outbox.send(ctx.channel, f"一次最多只能增加 `{limit}` 首")
+
+        msg = await self.outbox.send(ctx.channel, f"搜尋 `{len(queries)}` 首 :mag_right:")
+
+        nodes = self.get_nodes("search")
+        semaphore = asyncio.Semaphore(int(os.getenv("DISMUSIC_BATCH_CONCURRENCY", 4)))
+
+        async def resolve(index: int, query: str) -> list:
+            # Spread the searches across nodes, falling back to the rest in order
+            shift = index % len(nodes) if nodes else 0
+            async with semaphore:
+                return await self.search_tracks(
+                    query, self.get_provider(query, provider, player), nodes[shift:] + nodes[:shift]
+                )
+
+        results = await asyncio.gather(*(resolve(index, query) for index, query in enumerate(queries)))
+
+        tracks = [track for result in results for track in result]
+        failed = [query for query, result in zip(queries, results) if not result]
+
+        with tracer.span("enqueue", tracks=len(tracks)):
+            for track in tracks:
+                player.queue.put_nowait(track)
+
+        summary = f"增加 `{len(tracks)}` 首到播放列"
+        if failed:
+            summary += f"\n找不到 `{len(failed)}` 個: " + ", ".join(f"`{query}`" for query in failed)
+
+        await msg.edit(content=summary[:2000])
+
+        if tracks and not player.is_playing():
+            await player.do_next()
+
     async def start_nodes(self):
         await self.bot.wait_until_ready()
         spotify_credential = getattr(self.bot, "spotify_credentials", {"client_id": "", "client_secret": ""})
 
         for config in self.bot.lavalink_nodes:
+            config = dict(config)
+            role = config.pop("role", "both")
+
+            if role not in ROLES:
+                print(f"[dismusic] ERROR - Invalid role {role!r} for node {config['host']}:{config['port']}")
+                continue
+
             try:
                 node: wavelink.Node = await wavelink.NodePool.create_node(
                     bot=self.bot,
                     **config,
                     spotify_client=spotify.SpotifyClient(**spotify_credential),
                 )
-                print(f"[dismusic] INFO - Created node: {node.identifier}")
+                node_roles[node.identifier] = role
+                print(f"[dismusic] INFO - Created {role} node: {node.identifier}")
             except Exception:
                 print(f"[dismusic] ERROR - Failed to create node {config['host']}:{config['port']}")
 
@@ -112,10 +269,16 @@ class Music(commands.Cog):
         if ctx.voice_client:
             return
 
-        msg = await ctx.send(f"加入到 **`{ctx.author.voice.channel}`**")
+        entry = await self.state.find_player(ctx.guild.id)
+        if entry and entry["process"] != self.state.process_id:
+            raise PlayerInOtherProcess("這個伺服器已經有其他程序在播放了")
+
+        msg = await self.outbox.send(ctx.channel, f"加入到 **`{ctx.author.voice.channel}`**")
 
         try:
-            player: DisPlayer = await ctx.author.voice.channel.connect(cls=DisPlayer)
+            with tracer.span("connect"):
+                player: DisPlayer = await ctx.author.voice.channel.connect(cls=player_cls())
+            metrics.record_player(player.node)
             self.bot.dispatch("dismusic_player_connect", player)
         except (asyncio.TimeoutError, ClientException):
             return await msg.edit(content="無法加入語音")
@@ -132,6 +295,13 @@ class Music(commands.Cog):
         await ctx.invoke(self.connect)
         await self.play_track(ctx, query)
 
+    @play.command()
+    @voice_connected()
+    async def batch(self, ctx: commands.Context, *, queries: str = ""):
+        """Add many songs at once, one per line or from an attached .txt file"""
+        await ctx.invoke(self.connect)
+        await self.play_batch(ctx, queries)
+
     @play.command(aliases=["yt"])
     @voice_connected()
     async def youtube(self, ctx: commands.Context, *, query: str):
@@ -174,13 +344,13 @@ class Music(commands.Cog):
         player: DisPlayer = ctx.voice_client
 
         if vol < 0:
-            return await ctx.send("音量必須大於0")
+            return await self.outbox.send(ctx.channel, "音量必須大於0")
 
         if vol > 100 and not forced:
-            return await ctx.send("音量必須小於100")
+            return await self.outbox.send(ctx.channel, "音量必須小於100")
 
         await player.set_volume(vol)
-        await ctx.send(f"音量設定為 {vol} :loud_sound:")
+        await self.outbox.send(ctx.channel, f"音量設定為 {vol} :loud_sound:")
 
     @commands.command(aliases=["disconnect", "dc", "leave"])
     @voice_channel_player()
@@ -189,7 +359,7 @@ class Music(commands.Cog):
         player: DisPlayer = ctx.voice_client
 
         await player.destroy()
-        await ctx.send("停止播放 :stop_button: ")
+        await self.outbox.send(ctx.channel, "停止播放 :stop_button: ")
         self.bot.dispatch("dismusic_player_stop", player)
 
     @commands.command()
@@ -200,13 +370,13 @@ class Music(commands.Cog):
 
         if player.is_playing():
             if player.is_paused():
-                return await ctx.send("播放已經暫停")
+                return await self.outbox.send(ctx.channel, "播放已經暫停")
 
             await player.set_pause(pause=True)
             self.bot.dispatch("dismusic_player_pause", player)
-            return await ctx.send("暫停 :pause_button: ")
+            return await self.outbox.send(ctx.channel, "暫停 :pause_button: ")
 
-        await ctx.send("沒有在播放任何音源")
+        await self.outbox.send(ctx.channel, "沒有在播放任何音源")
 
     @commands.command()
     @voice_channel_player()
@@ -216,13 +386,13 @@ class Music(commands.Cog):
 
         if player.is_playing():
             if not player.is_paused():
-                return await ctx.send("正在播放中")
+                return await self.outbox.send(ctx.channel, "正在播放中")
 
             await player.set_pause(pause=False)
             self.bot.dispatch("dismusic_player_resume", player)
-            return await ctx.send("播放 :musical_note: ")
+            return await self.outbox.send(ctx.channel, "播放 :musical_note: ")
 
-        await ctx.send("沒有在播放任何音源")
+        await self.outbox.send(ctx.channel, "沒有在播放任何音源")
 
     @commands.command()
     @voice_channel_player()
@@ -236,7 +406,7 @@ class Music(commands.Cog):
         await player.stop()
 
         self.bot.dispatch("dismusic_track_skip", player)
-        await ctx.send("跳過 :track_next:")
+        await self.outbox.send(ctx.channel, "跳過 :track_next:")
 
     @commands.command()
     @voice_channel_player()
@@ -248,16 +418,16 @@ class Music(commands.Cog):
             old_position = player.position
             position = old_position + seconds
             if position > player.source.length:
-                return await ctx.send("超出歌曲時間長度")
+                return await self.outbox.send(ctx.channel, "超出歌曲時間長度")
 
             if position < 0:
                 position = 0
 
             await player.seek(position * 1000)
             self.bot.dispatch("dismusic_player_seek", player, old_position, position)
-            return await ctx.send(f"快轉到 {seconds} 秒 :fast_forward: ")
+            return await self.outbox.send(ctx.channel, f"快轉到 {seconds} 秒 :fast_forward: ")
 
-        await ctx.send("沒有在播放任何音源")
+        await self.outbox.send(ctx.channel, "沒有在播放任何音源")
 
     @commands.command()
     @voice_channel_player()
@@ -266,7 +436,7 @@ class Music(commands.Cog):
         player: DisPlayer = ctx.voice_client
 
         result = await player.set_loop(loop_type)
-        await ctx.send(f"循環播放設定為 {result} :repeat: ")
+        await self.outbox.send(ctx.channel, f"循環播放設定為 {result} :repeat: ")
 
     @commands.command(aliases=["q"])
     @voice_channel_player()
@@ -275,7 +445,7 @@ class Music(commands.Cog):
         player: DisPlayer = ctx.voice_client
 
         if len(player.queue._queue) < 1:
-            return await ctx.send("沒有音樂在播放列")
+            return await self.outbox.send(ctx.channel, "沒有音樂在播放列")
 
         paginator = Paginator(ctx, player)
         await paginator.start()
@@ -0,0 +1,95 @@
+import time
+from functools import partial
+
+import wavelink
+
+from .player import DisPlayer
+
+ROLES = ("search", "playback", "both")
+
+node_roles = {}
+
+# Filled in by SharedState from what the other processes report
+shared_load = {}
+# node key -> time.monotonic() the down mark expires at
+down_nodes = {}
+
+
+def node_key(node: wavelink.Node) -> str:
+    """Identifies a node the same way in every process"""
+    return f"{node.host}:{node.port}"
+
+
+def is_down(node: wavelink.Node) -> bool:
+    return down_nodes.get(node_key(node), 0) > time.monotonic()
+
+
+def node_role(node: wavelink.Node) -> str:
+    return node_roles.get(node.identifier, "both")
+
+
+def get_nodes(role: str = None):
+    """Nodes able to serve `role`, least busy first; falls back to every node if none can"""
+    nodes = sorted(
+        wavelink.NodePool._nodes.values(), key=lambda n: len(n.players) + shared_load.get(node_key(n), 0)
+    )
+    nodes = [node for node in nodes if not is_down(node)] or nodes
+
+    if not role:
+        return nodes
+
+    capable = [node for node in nodes if node_role(node) in (role, "both")]
+    if capable or not nodes:
+        return capable
+
+    metrics.fallbacks[role] += 1
+    return nodes
+
+
+def player_cls():
+    """Player class for `VoiceChannel.connect` that lands on a playback node"""
+    nodes = get_nodes("playback")
+    if not nodes:
+        return DisPlayer
+
+    return partial(DisPlayer, node=nodes[0])
+
+
+class NodeMetrics:
+    def __init__(self) -> None:
+        self.fallbacks = {"search": 0, "playback": 0}
+        self.players = {role: 0 for role in ROLES}
+        self.searches = {}
+
+    def record_player(self, node: wavelink.Node) -> None:
+        self.players[node_role(node)] += 1
+
+    def record_search(self, node: wavelink.Node, seconds: float, ok: bool) -> None:
+        stats = self.searches.setdefault(node.identifier, {"count": 0, "failed": 0, "seconds": 0.0})
+        stats["count"] += 1
+        stats["seconds"] += seconds
+        if not ok:
+            stats["failed"] += 1
+
+    def report(self) -> dict:
+        nodes = {}
+
+        for node in get_nodes():
+            stats = getattr(node, "stats", None)
+            searches = self.searches.get(node.identifier, {"count": 0, "failed": 0, "seconds": 0.0})
+
+            nodes[node.identifier] = {
+                "role": node_role(node),
+                "players": len(node.players),
+                "searches": searches["count"],
+                "search_failures": searches["failed"],
+                "search_avg_ms": searches["seconds"] / searches["count"] * 1000 if searches["count"] else 0.0,
+                "frames_sent": getattr(stats, "frames_sent", None),
+                "frames_nulled": getattr(stats, "frames_nulled", None),
+                "frames_deficit": getattr(stats, "frames_deficit", None),
+            }
+
+        return {"nodes": nodes, "fallbacks": dict(self.fallbacks), "players_created": dict(self.players)}
+
+
+metrics = NodeMetrics()
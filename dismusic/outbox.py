@@ -0,0 +1,249 @@
+import asyncio
+import os
+import time
+from collections import deque
+
+from discord import HTTPException
+
+MAX_CONTENT_LENGTH = 2000
+
+
+class RouteLimiter:
+    """Token bucket for a single Discord route, so we wait before hitting a 429"""
+
+    def __init__(self, rate: int, per: float) -> None:
+        self.rate = rate
+        self.per = per
+        self.tokens = float(rate)
+        self.updated = time.monotonic()
+
+    def delay(self) -> float:
+        now = time.monotonic()
+        self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate / self.per)
+        self.updated = now
+
+        if self.tokens >= 1:
+            return 0.0
+
+        return (1 - self.tokens) * self.per / self.rate
+
+    async def acquire(self) -> None:
+        delay = self.delay()
+        while delay > 0:
+            await asyncio.sleep(delay)
+            delay = self.delay()
+
+        self.tokens -= 1
+
+    def refill_time(self) -> float:
+        """Seconds until the bucket is full again"""
+        self.delay()
+        return (self.rate - self.tokens) * self.per / self.rate
+
+
+class PendingMessage:
+    """Handle for a message queued in the outbox"""
+
+    def __init__(self, outbox: "ChannelOutbox", content=None, embed=None, view=None) -> None:
+        self.outbox = outbox
+        self.content = content
+        self.embed = embed
+        self.view = view
+        self.group = None
+        self.done = asyncio.Event()
+
+    @property
+    def message(self):
+        return self.group.message if self.group else None
+
+    async def edit(self, content=None, embed=None, view=None) -> None:
+        if content is not None:
+            self.content = content
+        if embed is not None:
+            self.embed = embed
+        if view is not None:
+            self.view = view
+
+        if not self.group:
+            # Not sent yet, so the send itself carries the edit
+            self.outbox.manager.stats["folded"] += 1
+        elif self.group.message:
+            # The outbox that sent it may have been evicted since
+            self.outbox.manager.get_channel(self.outbox.channel).queue_edit(self.group)
+        else:
+            self.group.dirty = True
+
+    async def wait(self):
+        await self.done.wait()
+        return self.message
+
+
+class MessageGroup:
+    """Several pending messages delivered as one Discord message"""
+
+    def __init__(self, items) -> None:
+        self.items = items
+        self.message = None
+        self.dirty = False
+
+    def render(self) -> dict:
+        contents = [item.content for item in self.items if item.content]
+        embed = next((item.embed for item in self.items if item.embed), None)
+        view = next((item.view for item in self.items if item.view), None)
+
+        payload = {"content": "\n".join(contents) or None}
+        if embed:
+            payload["embed"] = embed
+        if view:
+            payload["view"] = view
+
+        return payload
+
+
+class ChannelOutbox:
+    def __init__(self, manager: "Outbox", channel) -> None:
+        self.manager = manager
+        self.channel = channel
+        self.pending = deque()
+        self.edits = {}
+        self.task = None
+        self.woken = asyncio.Event()
+        self.limiter = RouteLimiter(manager.rate, manager.per)
+
+    def can_merge(self, group, item) -> bool:
+        if item.embed and any(other.embed for other in group):
+            return False
+        if item.view and any(other.view for other in group):
+            return False
+
+        length = sum(len(other.content or "") + 1 for other in group)
+        return length + len(item.content or "") <= MAX_CONTENT_LENGTH
+
+    def enqueue(self, item: PendingMessage) -> None:
+        self.pending.append(item)
+        self.manager.stats["queued"] += 1
+        self.wake()
+
+    def queue_edit(self, group: MessageGroup) -> None:
+        if id(group) in self.edits:
+            self.manager.stats["dropped"] += 1
+
+        self.edits[id(group)] = group
+        self.wake()
+
+    def wake(self) -> None:
+        self.woken.set()
+
+        if not self.task or self.task.done():
+            self.task = asyncio.get_event_loop().create_task(self.flush())
+
+    async def flush(self) -> None:
+        while True:
+            while self.pending or self.edits:
+                await self.drain()
+
+            # Keep the bucket until it refills, so a fresh outbox can't burst past the limit,
+            # but go back to work as soon as something is queued
+            self.woken.clear()
+            try:
+                await asyncio.wait_for(self.woken.wait(), self.limiter.refill_time())
+            except asyncio.TimeoutError:
+                if not (self.pending or self.edits):
+                    break
+
+        if self.manager.channels.get(self.channel.id) is self:
+            del self.manager.channels[self.channel.id]
+
+    async def drain(self) -> None:
+        await asyncio.sleep(self.manager.window)
+
+        groups = []
+        while self.pending:
+            item = self.pending.popleft()
+            if groups and self.can_merge(groups[-1], item):
+                groups[-1].append(item)
+                self.manager.stats["merged"] += 1
+            else:
+                groups.append([item])
+
+        for items in groups:
+            await self.deliver(MessageGroup(items))
+
+        edits, self.edits = self.edits, {}
+        for group in edits.values():
+            await self.deliver_edit(group)
+
+    async def deliver(self, group: MessageGroup) -> None:
+        for item in group.items:
+            item.group = group
+
+        await self.limiter.acquire()
+        try:
+            group.message = await self.channel.send(**group.render())
+            self.manager.stats["sent"] += 1
+
+            if group.dirty:
+                self.queue_edit(group)
+        except HTTPException as e:
+            self.manager.stats["failed"] += 1
+            print(f"[dismusic] ERROR - Failed to send message to {self.channel.id}: {e}")
+        finally:
+            for item in group.items:
+                item.done.set()
+
+    async def deliver_edit(self, group: MessageGroup) -> None:
+        await self.limiter.acquire()
+        try:
+            await group.message.edit(**group.render())
+            self.manager.stats["edited"] += 1
+        except HTTPException as e:
+            self.manager.stats["failed"] += 1
+            print(f"[dismusic] ERROR - Failed to edit message {group.message.id}: {e}")
+
+
+class Outbox:
+    """Per-channel queue that coalesces dismusic replies into as few REST calls as possible.
+
+    Messages queued for the same channel within `DISMUSIC_OUTBOX_WINDOW` seconds are merged
+    into one message, edits made before the send are folded into it, edits superseded by a
+    newer edit are dropped, and every channel is throttled to `DISMUSIC_OUTBOX_RATE` calls per
+    `DISMUSIC_OUTBOX_PER` seconds. A channel's outbox is dropped once it is idle and its bucket
+    has refilled.
+    """
+
+    def __init__(self, window: float = None, rate: int = None, per: float = None) -> None:
+        self.window = window if window is not None else float(os.getenv("DISMUSIC_OUTBOX_WINDOW", 0.3))
+        self.rate = rate or int(os.getenv("DISMUSIC_OUTBOX_RATE", 5))
+        self.per = per or float(os.getenv("DISMUSIC_OUTBOX_PER", 5))
+
+        self.channels = {}
+        self.stats = {"queued": 0, "sent": 0, "edited": 0, "merged": 0, "folded": 0, "dropped": 0, "failed": 0}
+
+    def get_channel(self, channel) -> ChannelOutbox:
+        if channel.id not in self.channels:
+            self.channels[channel.id] = ChannelOutbox(self, channel)
+
+        return self.channels[channel.id]
+
+    async def send(self, channel, content=None, *, embed=None, view=None) -> PendingMessage:
+        outbox = self.get_channel(channel)
+        item = PendingMessage(outbox, content=content, embed=embed, view=view)
+        outbox.enqueue(item)
+
+        return item
+
+    def depth(self) -> int:
+        return sum(len(outbox.pending) + len(outbox.edits) for outbox in self.channels.values())
+
+    def report(self) -> dict:
+        return {**self.stats, "depth": self.depth()}
+
+
+def get_outbox(bot) -> Outbox:
+    outbox = getattr(bot, "dismusic_outbox", None)
+
+    if not outbox:
+        outbox = Outbox()
+        bot.dismusic_outbox = outbox
+
+    return outbox
@@ -4,6 +4,7 @@ import math
 from discord import Color, Embed, Forbidden, InvalidArgument, NotFound, HTTPException
 
 from ._emojis import emojis
+from .outbox import get_outbox
 
 class Paginator:
     def __init__(self, ctx, player) -> None:
@@ -58,16 +59,22 @@ class Paginator:
 
         total_pages = math.ceil(len(track_list) / per_page)
 
-        msg = None
+        outbox = get_outbox(self.ctx.bot)
+        pending = None
 
         while True:
             tracks = track_list[current_page * per_page: (current_page + 1) * per_page]
             embed = self.create_embed(tracks, current_page, total_pages)
 
-            if not msg:
-                msg = await self.ctx.send(embed=embed)
+            if not pending:
+                pending = await outbox.send(self.ctx.channel, embed=embed)
             else:
-                await msg.edit(embed=embed)
+                await pending.edit(embed=embed)
+
+            # Reactions need the sent message; they use their own routes, outside the outbox
+            msg = await pending.wait()
+            if not msg:
+                break
 
             if total_pages > 1:
                 try:
@@ -4,9 +4,11 @@ import os
 import async_timeout
 import discord
 from discord.ext import commands
-from wavelink import Player
+from wavelink import Node, NodePool, Player
 
 from .errors import InvalidLoopMode, NotEnoughSong, NothingIsPlaying
+from .outbox import get_outbox
+from .tracing import tracer
 
 
 class MusicControllerView(discord.ui.View):
@@ -95,6 +97,9 @@ class DisPlayer(Player):
         self.loop = "無"  # 當前歌曲, 播放列表
         self.bound_channel = None
         self.track_provider = "yt"
+        self.auto_paused = False
+        self.pending_node = None
+        self.pending_reason = None
 
     async def destroy(self) -> None:
         self.queue = None
@@ -102,23 +107,76 @@ class DisPlayer(Player):
         await super().stop()
         await super().disconnect()
 
+        # Free the player on the Lavalink side too, not just the voice connection
+        try:
+            await self.node._websocket.send(op="destroy", guildId=str(self.guild.id))
+        except Exception:
+            pass  # The node may already be gone
+
+    async def move_to_node(self, node: Node, reason: str = None) -> None:
+        """Move this player to another node by replaying its voice state there"""
+        old_node = self.node
+        self.pending_node = None
+        self.pending_reason = None
+
+        if node is old_node or node.identifier not in NodePool._nodes:
+            return
+
+        # Switch before awaiting anything, so a concurrent play already goes to the new node
+        if self in old_node._players:
+            old_node._players.remove(self)
+
+        self.node = node
+        node._players.append(self)
+
+        if self._voice_state:
+            await self._dispatch_voice_update(self._voice_state)
+
+        try:
+            await old_node._websocket.send(op="destroy", guildId=str(self.guild.id))
+        except Exception:
+            pass  # The old node may already be gone
+
+        if self.volume != 100:
+            await self.set_volume(self.volume)
+
+        print(
+            f"[dismusic] INFO - Moved player {self.guild.id} from {old_node.identifier} to {node.identifier}"
+            + (f": {reason}" if reason else "")
+        )
+        self.client.dispatch("dismusic_player_move", self, old_node, node)
+
+    async def apply_pending_move(self) -> None:
+        """Called between tracks, so a move is never heard"""
+        if self.pending_node:
+            await self.move_to_node(self.pending_node, self.pending_reason)
+
     async def do_next(self) -> None:
+        with tracer.span("do_next", guild=self.guild.id, node=self.node.identifier):
+            await self._do_next()
+
+    async def _do_next(self) -> None:
         if self.is_playing():
             return
 
         timeout = int(os.getenv("DISMUSIC_TIMEOUT", 300))
 
         try:
-            with async_timeout.timeout(timeout):
-                track = await self.queue.get()
+            # Waiting on an empty queue is idle time, not latency
+            with tracer.span("queue.get", idle=self.queue.empty() or None):
+                with async_timeout.timeout(timeout):
+                    track = await self.queue.get()
         except asyncio.TimeoutError:
             if not self.is_playing():
                 await self.destroy()
 
             return
 
+        await self.apply_pending_move()
+
         self._source = track
-        await self.play(track)
+        with tracer.span("play", node=self.node.identifier, provider=type(track).__name__):
+            await self.play(track)
         self.client.dispatch("dismusic_track_start", self, track)
         await self.invoke_player()
 
@@ -148,6 +206,10 @@ class DisPlayer(Player):
         return self.loop
 
     async def invoke_player(self, ctx: commands.Context = None) -> None:
+        with tracer.span("invoke_player", guild=self.guild.id):
+            await self._invoke_player(ctx)
+
+    async def _invoke_player(self, ctx: commands.Context = None) -> None:
         track = self.source
 
         if not track:
@@ -183,7 +245,6 @@ class DisPlayer(Player):
         if next_song:
             embed.add_field(name="下一首", value=next_song, inline=False)
 
-        if not ctx:
-            return await self.bound_channel.send(embed=embed, view=MusicControllerView())
-
-        await ctx.send(embed=embed, view=MusicControllerView())
+        channel = ctx.channel if ctx else self.bound_channel
+        with tracer.span("embed.send"):
+            await get_outbox(self.client).send(channel, embed=embed, view=MusicControllerView())
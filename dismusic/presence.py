@@ -0,0 +1,156 @@
+import asyncio
+import os
+from dataclasses import dataclass, field
+
+import discord
+from discord.ext import commands
+
+from .nodes import metrics, player_cls
+from .player import DisPlayer
+
+
+@dataclass
+class SavedPlayer:
+    channel_id: int
+    bound_channel: discord.abc.Messageable
+    track: object
+    position: float
+    queue: list = field(default_factory=list)
+    loop: str = "無"
+    volume: int = 100
+    paused: bool = False
+    track_provider: str = "yt"
+
+
+class MusicPresence(commands.Cog):
+    """Pauses players nobody is listening to and releases their node-side player after a grace period"""
+
+    def __init__(self, bot) -> None:
+        self.bot = bot
+        self.grace = float(os.getenv("DISMUSIC_EMPTY_GRACE", 60))
+        self.timers = {}
+        self.saved = {}
+        self.restoring = set()
+        self.stats = {"auto_paused": 0, "resumed": 0, "saved": 0, "restored": 0}
+
+    @staticmethod
+    def has_listeners(channel) -> bool:
+        return any(not member.bot for member in channel.members)
+
+    def cancel_timer(self, guild_id: int) -> bool:
+        task = self.timers.pop(guild_id, None)
+        if task and not task.done():
+            task.cancel()
+            return True
+
+        return False
+
+    @commands.Cog.listener()
+    async def on_voice_state_update(self, member, before, after):
+        guild = member.guild
+        player = guild.voice_client
+
+        if member.id == self.bot.user.id and not after.channel:
+            self.cancel_timer(guild.id)
+            return
+
+        if isinstance(player, DisPlayer):
+            if self.has_listeners(player.channel):
+                if self.cancel_timer(guild.id) and player.auto_paused:
+                    await self.resume(player)
+            elif guild.id not in self.timers and player.is_playing():
+                await self.auto_pause(player)
+            return
+
+        saved = self.saved.get(guild.id)
+        if saved and not member.bot and after.channel and after.channel.id == saved.channel_id:
+            if guild.id not in self.restoring:
+                await self.restore(after.channel)
+
+    async def auto_pause(self, player: DisPlayer) -> None:
+        if not player.is_paused():
+            await player.set_pause(pause=True)
+            player.auto_paused = True
+            self.stats["auto_paused"] += 1
+            self.bot.dispatch("dismusic_player_pause", player)
+
+        self.timers[player.guild.id] = self.bot.loop.create_task(self.release_later(player))
+
+    async def resume(self, player: DisPlayer) -> None:
+        player.auto_paused = False
+        await player.set_pause(pause=False)
+        self.stats["resumed"] += 1
+        self.bot.dispatch("dismusic_player_resume", player)
+
+    async def release_later(self, player: DisPlayer) -> None:
+        await asyncio.sleep(self.grace)
+        self.timers.pop(player.guild.id, None)
+
+        if not player.is_connected() or not player.is_playing() or self.has_listeners(player.channel):
+            return
+
+        await self.release(player)
+
+    async def release(self, player: DisPlayer) -> None:
+        guild_id = player.guild.id
+
+        saved = SavedPlayer(
+            channel_id=player.channel.id,
+            bound_channel=player.bound_channel,
+            track=player.source,
+            position=player.position,
+            queue=list(player.queue._queue),
+            loop=player.loop,
+            volume=player.volume,
+            paused=player.is_paused() and not player.auto_paused,
+            track_provider=player.track_provider,
+        )
+        self.saved[guild_id] = saved
+
+        await player.destroy()
+
+        self.stats["saved"] += 1
+        print(f"[dismusic] INFO - Released player for guild {guild_id} ({self.stats['saved']} node players saved)")
+        self.bot.dispatch("dismusic_player_saved", guild_id, saved)
+
+        # Forget the saved player once it would have timed out anyway
+        await asyncio.sleep(int(os.getenv("DISMUSIC_TIMEOUT", 300)))
+        if self.saved.get(guild_id) is saved:
+            del self.saved[guild_id]
+
+    async def restore(self, channel) -> None:
+        guild_id = channel.guild.id
+        saved = self.saved[guild_id]
+
+        self.restoring.add(guild_id)
+        try:
+            player: DisPlayer = await channel.connect(cls=player_cls())
+        except (asyncio.TimeoutError, discord.ClientException):
+            # Keep the saved player so the next join can try again
+            print(f"[dismusic] ERROR - Failed to restore player for guild {guild_id}")
+            return
+        finally:
+            self.restoring.discard(guild_id)
+
+        if self.saved.get(guild_id) is saved:
+            del self.saved[guild_id]
+
+        player.bound_channel = saved.bound_channel
+        player.bot = self.bot
+        player.loop = saved.loop
+        player.track_provider = saved.track_provider
+
+        for track in saved.queue:
+            player.queue.put_nowait(track)
+
+        player._source = saved.track
+        await player.set_volume(saved.volume)
+        await player.play(saved.track, start=int(saved.position * 1000))
+
+        if saved.paused:
+            await player.set_pause(pause=True)
+
+        self.stats["restored"] += 1
+        metrics.record_player(player.node)
+        self.bot.dispatch("dismusic_player_connect", player)
+        self.bot.dispatch("dismusic_player_restore", player)
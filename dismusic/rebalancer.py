@@ -0,0 +1,120 @@
+import asyncio
+import os
+import time
+from collections import deque
+
+import wavelink
+
+from .nodes import get_nodes, node_key, shared_load
+from .player import DisPlayer
+
+
+def node_load(node: wavelink.Node) -> float:
+    """Lavalink's usual node penalty, using known player counts since stats lag behind moves"""
+    load = float(len(node.players) + shared_load.get(node_key(node), 0))
+    stats = getattr(node, "stats", None)
+
+    if not stats:
+        return load
+
+    load += 1.05 ** (100 * getattr(stats, "system_load", 0)) * 10 - 10
+
+    deficit = getattr(stats, "frames_deficit", -1)
+    nulled = getattr(stats, "frames_nulled", -1)
+    if deficit > 0:
+        load += 1.03 ** (500 * deficit / 3000) * 600 - 600
+    if nulled > 0:
+        load += (1.03 ** (500 * nulled / 3000) * 300 - 300) * 2
+
+    return load
+
+
+class NodeRebalancer:
+    """Moves players off overloaded nodes between tracks.
+
+    Every `DISMUSIC_REBALANCE_INTERVAL` seconds the busiest node is compared to the average.
+    Players are only moved when it is `DISMUSIC_REBALANCE_THRESHOLD` above the average and at
+    least `DISMUSIC_REBALANCE_MARGIN` above the idlest node, a player is not moved again within
+    `DISMUSIC_REBALANCE_COOLDOWN` seconds, and at most `DISMUSIC_REBALANCE_MAX_MOVES` moves are
+    scheduled per minute.
+    """
+
+    def __init__(self, bot) -> None:
+        self.bot = bot
+        self.interval = float(os.getenv("DISMUSIC_REBALANCE_INTERVAL", 60))
+        self.threshold = float(os.getenv("DISMUSIC_REBALANCE_THRESHOLD", 0.25))
+        self.margin = float(os.getenv("DISMUSIC_REBALANCE_MARGIN", 2))
+        self.cooldown = float(os.getenv("DISMUSIC_REBALANCE_COOLDOWN", 600))
+        self.max_moves = int(os.getenv("DISMUSIC_REBALANCE_MAX_MOVES", 10))
+
+        self.moves = deque()
+        self.moved_at = {}
+
+    def nodes(self):
+        return get_nodes("playback")
+
+    def budget(self) -> int:
+        now = time.monotonic()
+        while self.moves and now - self.moves[0] > 60:
+            self.moves.popleft()
+
+        return self.max_moves - len(self.moves)
+
+    def candidates(self, node: wavelink.Node):
+        for player in list(node.players):
+            if not isinstance(player, DisPlayer) or player.pending_node:
+                continue
+            if player.guild.id in self.moved_at:
+                continue
+
+            yield player
+
+    async def rebalance(self) -> None:
+        nodes = self.nodes()
+        if len(nodes) < 2:
+            return
+
+        now = time.monotonic()
+        self.moved_at = {guild: at for guild, at in self.moved_at.items() if now - at < self.cooldown}
+
+        loads = {node.identifier: node_load(node) for node in nodes}
+        average = sum(loads.values()) / len(loads)
+
+        source = max(nodes, key=lambda n: loads[n.identifier])
+        target = min(nodes, key=lambda n: loads[n.identifier])
+        source_load, target_load = loads[source.identifier], loads[target.identifier]
+
+        if source_load <= average * (1 + self.threshold) or source_load - target_load < self.margin:
+            return
+
+        # Every process sees the same loads, so each only moves its own share of the excess
+        local = len(source.players)
+        share = local / (local + shared_load.get(node_key(source), 0)) if local else 0.0
+
+        pending = sum(1 for player in source.players if getattr(player, "pending_node", None))
+        count = min(int((source_load - target_load) // 2 * share) - pending, self.budget())
+        reason = f"{source.identifier} load {source_load:.1f} vs average {average:.1f}, {target.identifier} {target_load:.1f}"
+
+        for player in list(self.candidates(source))[: max(0, count)]:
+            self.moves.append(now)
+            self.moved_at[player.guild.id] = now
+
+            if player.is_playing():
+                player.pending_node = target
+                player.pending_reason = reason
+            else:
+                await player.move_to_node(target, reason)
+
+    async def run(self) -> None:
+        if self.interval <= 0:
+            return
+
+        await self.bot.wait_until_ready()
+
+        while not self.bot.is_closed():
+            await asyncio.sleep(self.interval)
+
+            try:
+                await self.rebalance()
+            except Exception as e:
+                print(f"[dismusic] ERROR - Rebalance failed: {e}")
@@ -0,0 +1,710 @@
+"""Load simulator for the dismusic cogs.
+
+Runs the real `Music` and `MusicEvents` cogs against simulated guilds, voice channels and
+users, and against local stand-in Lavalink nodes that stream nothing but emit the same
+track end, stuck and exception events a real node would.
+
+    python -m dismusic.simulator --guilds 1000 --users 3 --duration 120 --nodes 2
+"""
+import argparse
+import asyncio
+import base64
+import itertools
+import json
+import random
+import socket
+import time
+import tracemalloc
+from types import SimpleNamespace
+
+import discord
+from aiohttp import WSMsgType, web
+from discord.ext import commands
+from discord.ext.commands.view import StringView
+
+from .events import MusicEvents
+from .music import Music
+from .nodes import metrics
+
+DEFAULT_MIX = {"play": 6, "skip": 2, "queue": 1, "nowplaying": 1}
+
+
+def percentile(values, percent):
+    if not values:
+        return 0.0
+
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(percent / 100 * (len(values) - 1))))
+    return values[index]
+
+
+class FakeLavalink:
+    """Local stand-in for a Lavalink v3 node"""
+
+    def __init__(
+        self,
+        identifier: str,
+        *,
+        role: str = "both",
+        password: str = "dismusic",
+        track_length: float = 30.0,
+        search_latency: float = 0.05,
+        stuck_rate: float = 0.01,
+        exception_rate: float = 0.01,
+        stats_interval: float = 5.0,
+    ) -> None:
+        self.identifier = identifier
+        self.role = role
+        self.password = password
+        self.track_length = track_length
+        self.search_latency = search_latency
+        self.stuck_rate = stuck_rate
+        self.exception_rate = exception_rate
+        self.stats_interval = stats_interval
+
+        self.port = None
+        self.runner = None
+        self.sockets = set()
+        self.playing = {}
+        self.current = {}
+        self.players = set()
+        self.started = time.monotonic()
+        self.recent_searches = 0
+        self.counters = {"loadtracks": 0, "decodetrack": 0, "ops": 0, "events": 0}
+
+    @property
+    def config(self) -> dict:
+        return {
+            "host": "127.0.0.1",
+            "port": self.port,
+            "password": self.password,
+            "identifier": self.identifier,
+            "role": self.role,
+        }
+
+    @staticmethod
+    def encode_track(info: dict) -> str:
+        return base64.b64encode(json.dumps(info).encode()).decode()
+
+    @staticmethod
+    def decode_track(track: str) -> dict:
+        return json.loads(base64.b64decode(track.encode()))
+
+    def make_track(self, query: str, index: int) -> dict:
+        identifier = f"{abs(hash((query, index))) % 10 ** 11:011d}"
+        info = {
+            "identifier": identifier,
+            "isSeekable": True,
+            "author": "dismusic simulator",
+            "length": int(self.track_length * 1000),
+            "isStream": False,
+            "position": 0,
+            "title": f"{query} #{index}",
+            "uri": f"https://www.youtube.com/watch?v={identifier}",
+            "sourceName": "youtube",
+        }
+        return {"track": self.encode_track(info), "info": info}
+
+    async def start(self) -> None:
+        app = web.Application()
+        app.router.add_get("/", self.handle_websocket)
+        app.router.add_get("/loadtracks", self.handle_loadtracks)
+        app.router.add_get("/decodetrack", self.handle_decodetrack)
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind(("127.0.0.1", 0))
+        self.port = sock.getsockname()[1]
+
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        await web.SockSite(self.runner, sock).start()
+
+    async def close(self) -> None:
+        for task in self.playing.values():
+            task.cancel()
+
+        for ws in list(self.sockets):
+            await ws.close()
+
+        if self.runner:
+            await self.runner.cleanup()
+
+    async def handle_loadtracks(self, request: web.Request) -> web.Response:
+        self.counters["loadtracks"] += 1
+        self.recent_searches += 1
+        await asyncio.sleep(self.search_latency)
+
+        query = request.query.get("identifier", "")
+
+        if "playlist" in query:
+            tracks = [self.make_track(query, index) for index in range(random.randint(5, 25))]
+            return web.json_response(
+                {
+                    "loadType": "PLAYLIST_LOADED",
+                    "playlistInfo": {"name": query, "selectedTrack": -1},
+                    "tracks": tracks,
+                }
+            )
+
+        tracks = [self.make_track(query, index) for index in range(5)]
+        return web.json_response({"loadType": "SEARCH_RESULT", "playlistInfo": {}, "tracks": tracks})
+
+    async def handle_decodetrack(self, request: web.Request) -> web.Response:
+        self.counters["decodetrack"] += 1
+        return web.json_response(self.decode_track(request.query["track"]))
+
+    async def handle_websocket(self, request: web.Request) -> web.WebSocketResponse:
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        self.sockets.add(ws)
+
+        stats = asyncio.get_event_loop().create_task(self.send_stats(ws))
+
+        try:
+            async for message in ws:
+                if message.type == WSMsgType.TEXT:
+                    await self.handle_op(ws, json.loads(message.data))
+        finally:
+            stats.cancel()
+            self.sockets.discard(ws)
+
+        return ws
+
+    async def handle_op(self, ws: web.WebSocketResponse, data: dict) -> None:
+        self.counters["ops"] += 1
+        op = data.get("op")
+        guild_id = data.get("guildId")
+
+        if op == "play":
+            self.players.add(guild_id)
+            self.cancel(guild_id)
+            self.current[guild_id] = data["track"]
+            self.playing[guild_id] = asyncio.get_event_loop().create_task(
+                self.run_track(ws, guild_id, data["track"])
+            )
+        elif op == "stop":
+            if self.cancel(guild_id):
+                await self.send_event(ws, guild_id, self.current[guild_id], "TrackEndEvent", reason="STOPPED")
+        elif op == "destroy":
+            self.cancel(guild_id)
+            self.current.pop(guild_id, None)
+            self.players.discard(guild_id)
+
+    def cancel(self, guild_id: str) -> bool:
+        task = self.playing.pop(guild_id, None)
+        if task and not task.done():
+            task.cancel()
+            return True
+
+        return False
+
+    async def run_track(self, ws: web.WebSocketResponse, guild_id: str, track: str) -> None:
+        roll = random.random()
+
+        if roll < self.stuck_rate:
+            await asyncio.sleep(random.uniform(0, self.track_length))
+            await self.send_event(ws, guild_id, track, "TrackStuckEvent", thresholdMs=10000)
+        elif roll < self.stuck_rate + self.exception_rate:
+            await asyncio.sleep(random.uniform(0, self.track_length))
+            exception = {"message": "Simulated failure", "severity": "COMMON", "cause": "dismusic simulator"}
+            await self.send_event(ws, guild_id, track, "TrackExceptionEvent", exception=exception)
+        else:
+            await asyncio.sleep(self.track_length)
+
+        self.playing.pop(guild_id, None)
+        await self.send_event(ws, guild_id, track, "TrackEndEvent", reason="FINISHED")
+
+    async def send_event(self, ws: web.WebSocketResponse, guild_id: str, track: str, event: str, **payload) -> None:
+        if ws.closed:
+            return
+
+        self.counters["events"] += 1
+        await ws.send_json({"op": "event", "type": event, "guildId": guild_id, "track": track, **payload})
+
+    async def send_stats(self, ws: web.WebSocketResponse) -> None:
+        while not ws.closed:
+            playing = len(self.playing)
+            # Search bursts cost CPU that playing players pay for in dropped frames
+            nulled = int(playing * 3000 * min(0.5, self.recent_searches / (100 * self.stats_interval)))
+            self.recent_searches = 0
+
+            await ws.send_json(
+                {
+                    "op": "stats",
+                    "players": len(self.players),
+                    "playingPlayers": playing,
+                    "uptime": int((time.monotonic() - self.started) * 1000),
+                    "memory": {"free": 0, "used": 0, "allocated": 0, "reservable": 0},
+                    "cpu": {"cores": 4, "systemLoad": 0.0, "lavalinkLoad": min(1.0, playing / 500)},
+                    "frameStats": {"sent": playing * 3000 - nulled, "nulled": nulled, "deficit": 0},
+                }
+            )
+            await asyncio.sleep(self.stats_interval)
+
+
+class FakeRedis:
+    """Local stand-in for a Redis server, speaking just enough RESP for `RedisBackend`"""
+
+    def __init__(self) -> None:
+        self.port = None
+        self.server = None
+        self.values = {}
+        self.hashes = {}
+        self.commands = 0
+
+    @property
+    def url(self) -> str:
+        return f"redis://127.0.0.1:{self.port}/0"
+
+    async def start(self) -> None:
+        self.server = await asyncio.start_server(self.handle, "127.0.0.1", 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def close(self) -> None:
+        self.server.close()
+        await self.server.wait_closed()
+
+    @staticmethod
+    def encode(value) -> bytes:
+        if value is None:
+            return b"$-1\r\n"
+        if isinstance(value, int):
+            return f":{value}\r\n".encode()
+        if isinstance(value, list):
+            return f"*{len(value)}\r\n".encode() + b"".join(FakeRedis.encode(item) for item in value)
+
+        data = str(value).encode()
+        return f"${len(data)}\r\n".encode() + data + b"\r\n"
+
+    def get(self, key: str):
+        value, expires = self.values.get(key, (None, None))
+        if expires and expires < time.monotonic():
+            del self.values[key]
+            return None
+
+        return value
+
+    def run(self, name: str, args: list) -> bytes:
+        self.commands += 1
+
+        if name in ("PING", "AUTH", "SELECT"):
+            return b"+OK\r\n"
+        if name == "GET":
+            return self.encode(self.get(args[0]))
+        if name == "SET":
+            expires = time.monotonic() + int(args[3]) / 1000 if len(args) > 3 and args[2].upper() == "PX" else None
+            self.values[args[0]] = (args[1], expires)
+            return b"+OK\r\n"
+        if name == "DEL":
+            return self.encode(sum(bool(self.values.pop(key, None) or self.hashes.pop(key, None)) for key in args))
+        if name == "HSET":
+            fields = self.hashes.setdefault(args[0], {})
+            added = [key for key in args[1::2] if key not in fields]
+            fields.update(zip(args[1::2], args[2::2]))
+            return self.encode(len(added))
+        if name == "HGET":
+            return self.encode(self.hashes.get(args[0], {}).get(args[1]))
+        if name == "HGETALL":
+            return self.encode([part for item in self.hashes.get(args[0], {}).items() for part in item])
+        if name == "HDEL":
+            fields = self.hashes.get(args[0], {})
+            return self.encode(sum(fields.pop(key, None) is not None for key in args[1:]))
+
+        return f"-ERR unknown command '{name}'\r\n".encode()
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+
+                args = []
+                for _ in range(int(line[1:-2])):
+                    length = int((await reader.readline())[1:-2])
+                    args.append((await reader.readexactly(length + 2))[:-2].decode())
+
+                writer.write(self.run(args[0].upper(), args[1:]))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            # Cancelled when the loop shuts down with a client still connected
+            pass
+        finally:
+            writer.close()
+
+
+class SimMessage:
+    def __init__(self, channel: "SimTextChannel", content=None, embed=None, author=None) -> None:
+        self.id = next(channel.guild.simulation.ids)
+        self.channel = channel
+        self.guild = channel.guild
+        self.author = author
+        self.content = content
+        self.embeds = [embed] if embed else []
+        self.attachments = []
+        self._state = channel.guild.simulation.bot._connection
+
+    async def edit(self, content=None, embed=None, **kwargs):
+        self.guild.simulation.count_rest("edit_message")
+        if content is not None:
+            self.content = content
+
+        return self
+
+    async def add_reaction(self, emoji) -> None:
+        self.guild.simulation.count_rest("add_reaction")
+
+    async def remove_reaction(self, emoji, member) -> None:
+        self.guild.simulation.count_rest("remove_reaction")
+
+
+class SimTextChannel:
+    def __init__(self, guild: "SimGuild") -> None:
+        self.id = next(guild.simulation.ids)
+        self.name = f"music-{guild.id}"
+        self.guild = guild
+
+    async def send(self, content=None, *, embed=None, view=None, **kwargs) -> SimMessage:
+        self.guild.simulation.count_rest("send_message")
+        return SimMessage(self, content=content, embed=embed)
+
+
+class SimVoiceChannel:
+    def __init__(self, guild: "SimGuild") -> None:
+        self.id = next(guild.simulation.ids)
+        self.name = f"voice-{guild.id}"
+        self.guild = guild
+        self.members = []
+
+    def __str__(self) -> str:
+        return self.name
+
+    def _get_voice_client_key(self):
+        return self.guild.id, "guild_id"
+
+    async def connect(self, *, timeout: float = 60.0, reconnect: bool = True, cls=discord.VoiceClient):
+        state = self.guild.simulation.bot._connection
+        key_id, _ = self._get_voice_client_key()
+
+        voice = cls(self.guild.simulation.bot, self)
+        state._add_voice_client(key_id, voice)
+
+        try:
+            await voice.connect(timeout=timeout, reconnect=reconnect)
+        except asyncio.TimeoutError:
+            state._remove_voice_client(key_id)
+            raise
+
+        return voice
+
+
+class SimGuild:
+    def __init__(self, simulation: "Simulation") -> None:
+        self.simulation = simulation
+        self.id = next(simulation.ids)
+        self.name = f"guild-{self.id}"
+        self.text_channel = SimTextChannel(self)
+        self.voice_channel = SimVoiceChannel(self)
+
+    @property
+    def voice_client(self):
+        return self.simulation.bot._connection._get_voice_client(self.id)
+
+    async def change_voice_state(self, *, channel=None, self_mute=False, self_deaf=False) -> None:
+        self.simulation.counters["gateway_voice_updates"] += 1
+
+
+class SimUser:
+    def __init__(self, simulation: "Simulation", *, guild: SimGuild = None, bot: bool = False) -> None:
+        self.id = next(simulation.ids)
+        self.name = f"user-{self.id}"
+        self.display_name = self.name
+        self.bot = bot
+        self.guild = guild
+        self.display_avatar = SimpleNamespace(url="https://cdn.discordapp.com/embed/avatars/0.png")
+        self.voice = SimpleNamespace(channel=guild.voice_channel) if guild else None
+
+        if guild:
+            guild.voice_channel.members.append(self)
+
+    def __str__(self) -> str:
+        return self.name
+
+
+class SimContext(commands.Context):
+    """`commands.Context` for a simulated message, so commands go through `bot.invoke` like real ones"""
+
+    def __init__(self, bot, guild: SimGuild, author: SimUser, command, arguments: str = "") -> None:
+        message = SimMessage(guild.text_channel, content=f"!{command.qualified_name} {arguments}", author=author)
+        super().__init__(
+            message=message,
+            bot=bot,
+            view=StringView(arguments),
+            prefix="!",
+            command=command,
+            invoked_with=command.name,
+        )
+
+    async def send(self, content=None, **kwargs):
+        return await self.channel.send(content, **kwargs)
+
+
+class SimBot(commands.Bot):
+    """Bot that never connects to Discord; the simulation plays the gateway's part"""
+
+    def __init__(self, simulation: "Simulation", **kwargs) -> None:
+        super().__init__(command_prefix="!", intents=discord.Intents.none(), **kwargs)
+        self.simulation = simulation
+        self.sim_user = SimUser(simulation, bot=True)
+
+    @property
+    def user(self):
+        return self.sim_user
+
+    @property
+    def application_id(self):
+        return self.sim_user.id
+
+    async def wait_until_ready(self) -> None:
+        return
+
+    def get_guild(self, guild_id: int):
+        return self.simulation.guilds.get(guild_id)
+
+    async def wait_for(self, event, *, check=None, timeout=None):
+        # Simulated users never react to paginators
+        if event == "reaction_add":
+            raise asyncio.TimeoutError
+
+        return await super().wait_for(event, check=check, timeout=timeout)
+
+    def dispatch(self, event_name: str, *args, **kwargs) -> None:
+        self.simulation.counters["dispatches"] += 1
+        super().dispatch(event_name, *args, **kwargs)
+
+
+class Simulation:
+    def __init__(
+        self,
+        *,
+        guilds: int = 100,
+        users: int = 3,
+        duration: float = 60.0,
+        nodes: int = 2,
+        search_nodes: int = 0,
+        shared_state: bool = False,
+        mix: dict = None,
+        think_time: float = 5.0,
+        track_length: float = 30.0,
+        search_latency: float = 0.05,
+        stuck_rate: float = 0.01,
+        exception_rate: float = 0.01,
+        lag_interval: float = 0.05,
+    ) -> None:
+        self.guild_count = guilds
+        self.users_per_guild = users
+        self.duration = duration
+        self.mix = mix or DEFAULT_MIX
+        self.think_time = think_time
+        self.lag_interval = lag_interval
+
+        self.ids = itertools.count(10 ** 17)
+        self.guilds = {}
+        self.users = []
+        self.bot = None
+        self.music = None
+
+        self.nodes = [
+            FakeLavalink(
+                f"SIM-{index}",
+                role=("search" if index < search_nodes else "playback") if search_nodes else "both",
+                track_length=track_length,
+                search_latency=search_latency,
+                stuck_rate=stuck_rate,
+                exception_rate=exception_rate,
+            )
+            for index in range(nodes)
+        ]
+
+        self.redis = FakeRedis() if shared_state else None
+        self.latencies = {name: [] for name in self.mix}
+        self.errors = {name: 0 for name in self.mix}
+        self.lag = []
+        self.rest = {}
+        self.counters = {"dispatches": 0, "gateway_voice_updates": 0}
+
+    def count_rest(self, route: str) -> None:
+        self.rest[route] = self.rest.get(route, 0) + 1
+
+    def command_arguments(self, name: str) -> str:
+        if name == "play":
+            return random.choice(["lofi", "synthwave", "jazz", "city pop", "playlist mix"])
+        if name == "volume":
+            return str(random.randint(10, 100))
+        if name == "seek":
+            return str(random.randint(-10, 10))
+
+        return ""
+
+    async def run_command(self, guild: SimGuild, user: SimUser, name: str) -> None:
+        command = self.bot.get_command(name)
+        ctx = SimContext(self.bot, guild, user, command, self.command_arguments(name))
+
+        # Through bot.invoke, so cog hooks run and failures reach on_command_error and its reply
+        started = time.perf_counter()
+        await self.bot.invoke(ctx)
+        self.latencies[name].append(time.perf_counter() - started)
+
+        if ctx.command_failed:
+            self.errors[name] += 1
+
+    async def user_loop(self, guild: SimGuild, user: SimUser, deadline: float) -> None:
+        names = list(self.mix)
+        weights = [self.mix[name] for name in names]
+
+        while time.monotonic() < deadline:
+            await asyncio.sleep(random.expovariate(1 / self.think_time))
+            await self.run_command(guild, user, random.choices(names, weights)[0])
+
+    async def measure_lag(self, deadline: float) -> None:
+        while time.monotonic() < deadline:
+            started = time.perf_counter()
+            await asyncio.sleep(self.lag_interval)
+            self.lag.append(max(0.0, time.perf_counter() - started - self.lag_interval))
+
+    async def setup(self) -> None:
+        for node in self.nodes:
+            await node.start()
+
+        self.bot = SimBot(self)
+        self.bot.lavalink_nodes = [node.config for node in self.nodes]
+
+        if self.redis:
+            await self.redis.start()
+            self.bot.dismusic_state_url = self.redis.url
+
+        self.music = Music(self.bot)
+        self.bot.add_cog(self.music)
+        self.bot.add_cog(MusicEvents(self.bot))
+
+        # Music schedules start_nodes itself; wait for it to reach every stand-in node
+        while len(self.music.get_nodes()) < len(self.nodes):
+            await asyncio.sleep(0.1)
+
+        for _ in range(self.guild_count):
+            guild = SimGuild(self)
+            self.guilds[guild.id] = guild
+            self.users.extend(SimUser(self, guild=guild) for _ in range(self.users_per_guild))
+
+    async def teardown(self) -> None:
+        # Stop the state sync first, or it reconnects to the stand-in Redis after it is closed
+        for task in self.music.tasks:
+            task.cancel()
+
+        for node in list(self.music.get_nodes()):
+            try:
+                await node.disconnect(force=True)
+            except Exception:
+                pass
+
+        for node in self.nodes:
+            await node.close()
+
+        await self.music.state.backend.close()
+        if self.redis:
+            await self.redis.close()
+
+    async def run(self) -> dict:
+        tracemalloc.start()
+        await self.setup()
+        memory_before, _ = tracemalloc.get_traced_memory()
+
+        deadline = time.monotonic() + self.duration
+        tasks = [self.user_loop(user.guild, user, deadline) for user in self.users]
+        await asyncio.gather(self.measure_lag(deadline), *tasks)
+
+        memory_after, memory_peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        # Before teardown, which disconnects the nodes the metrics report walks
+        report = {
+            "guilds": self.guild_count,
+            "users": len(self.users),
+            "duration": self.duration,
+            "loop_lag_ms": {
+                "p50": percentile(self.lag, 50) * 1000,
+                "p99": percentile(self.lag, 99) * 1000,
+                "max": max(self.lag, default=0.0) * 1000,
+            },
+            "commands": {
+                name: {
+                    "count": len(latencies),
+                    "errors": self.errors[name],
+                    "p50_ms": percentile(latencies, 50) * 1000,
+                    "p95_ms": percentile(latencies, 95) * 1000,
+                    "p99_ms": percentile(latencies, 99) * 1000,
+                }
+                for name, latencies in self.latencies.items()
+            },
+            "memory_kb": {
+                "before": memory_before / 1024,
+                "after": memory_after / 1024,
+                "growth": (memory_after - memory_before) / 1024,
+                "peak": memory_peak / 1024,
+            },
+            "discord_rest": {**self.rest, "total": sum(self.rest.values())},
+            "outbox": self.music.outbox.report(),
+            "node_metrics": metrics.report(),
+            "shared_state": {**self.music.state.stats, "commands": self.redis.commands if self.redis else None},
+            "lavalink": {node.identifier: dict(node.counters) for node in self.nodes},
+            **self.counters,
+        }
+
+        await self.teardown()
+        return report
+
+
+def parse_mix(value: str) -> dict:
+    mix = {}
+    for part in value.split(","):
+        name, _, weight = part.partition("=")
+        mix[name.strip()] = float(weight or 1)
+
+    return mix
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Simulate many guilds using the dismusic cogs")
+    parser.add_argument("--guilds", type=int, default=100)
+    parser.add_argument("--users", type=int, default=3, help="Users per guild")
+    parser.add_argument("--duration", type=float, default=60.0, help="Seconds to run")
+    parser.add_argument("--nodes", type=int, default=2, help="Fake Lavalink nodes")
+    parser.add_argument("--search-nodes", type=int, default=0, help="How many of the nodes only serve searches")
+    parser.add_argument("--shared-state", action="store_true", help="Use the Redis backend against a stand-in server")
+    parser.add_argument("--mix", type=parse_mix, default=DEFAULT_MIX, help="e.g. play=6,skip=2,queue=1")
+    parser.add_argument("--think-time", type=float, default=5.0, help="Mean seconds between commands per user")
+    parser.add_argument("--track-length", type=float, default=30.0)
+    parser.add_argument("--search-latency", type=float, default=0.05)
+    parser.add_argument("--stuck-rate", type=float, default=0.01)
+    parser.add_argument("--exception-rate", type=float, default=0.01)
+    args = parser.parse_args()
+
+    simulation = Simulation(
+        guilds=args.guilds,
+        users=args.users,
+        duration=args.duration,
+        nodes=args.nodes,
+        search_nodes=args.search_nodes,
+        shared_state=args.shared_state,
+        mix=args.mix,
+        think_time=args.think_time,
+        track_length=args.track_length,
+        search_latency=args.search_latency,
+        stuck_rate=args.stuck_rate,
+        exception_rate=args.exception_rate,
+    )
+    print(json.dumps(asyncio.run(simulation.run()), indent=2, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
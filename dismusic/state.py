@@ -0,0 +1,339 @@
+import asyncio
+import json
+import os
+import socket
+import time
+from urllib.parse import urlparse
+
+import wavelink
+from wavelink import SoundCloudTrack, YouTubeMusicTrack, YouTubeTrack
+
+from . import nodes
+from .player import DisPlayer
+
+CACHEABLE_TRACKS = {cls.__name__: cls for cls in (wavelink.Track, YouTubeTrack, YouTubeMusicTrack, SoundCloudTrack)}
+
+
+class StateError(Exception):
+    """Error reply from the shared state backend"""
+
+    pass
+
+
+class MemoryBackend:
+    """In-process backend, the default when no shared state URL is configured"""
+
+    def __init__(self) -> None:
+        self.values = {}
+        self.hashes = {}
+
+    def _alive(self, key: str):
+        value, expires = self.values.get(key, (None, None))
+        if expires and expires < time.monotonic():
+            del self.values[key]
+            return None
+
+        return value
+
+    async def get(self, key: str):
+        return self._alive(key)
+
+    async def set(self, key: str, value: str, ttl: float = None) -> None:
+        self.values[key] = (value, time.monotonic() + ttl if ttl else None)
+
+    async def delete(self, key: str) -> None:
+        self.values.pop(key, None)
+        self.hashes.pop(key, None)
+
+    async def hset(self, name: str, mapping: dict) -> None:
+        self.hashes.setdefault(name, {}).update(mapping)
+
+    async def hget(self, name: str, field: str):
+        return self.hashes.get(name, {}).get(field)
+
+    async def hgetall(self, name: str) -> dict:
+        return dict(self.hashes.get(name, {}))
+
+    async def hdel(self, name: str, *fields) -> None:
+        for field in fields:
+            self.hashes.get(name, {}).pop(field, None)
+
+    async def close(self) -> None:
+        pass
+
+
+class RedisBackend:
+    """Minimal RESP client, enough for the commands dismusic needs"""
+
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 6379,
+        db: int = 0,
+        password: str = None,
+        timeout: float = 2.0,
+        ssl: bool = False,
+    ) -> None:
+        self.host = host
+        self.port = port
+        self.db = db
+        self.password = password
+        self.timeout = timeout
+        self.ssl = ssl
+        self.reader = None
+        self.writer = None
+        self.lock = asyncio.Lock()
+
+    @classmethod
+    def from_url(cls, url: str) -> "RedisBackend":
+        parsed = urlparse(url)
+        db = parsed.path.strip("/")
+
+        return cls(
+            host=parsed.hostname or "127.0.0.1",
+            port=parsed.port or 6379,
+            db=int(db) if db else 0,
+            password=parsed.password,
+            timeout=float(os.getenv("DISMUSIC_STATE_TIMEOUT", 2)),
+            ssl=parsed.scheme == "rediss",
+        )
+
+    @staticmethod
+    def encode(*args) -> bytes:
+        parts = [f"*{len(args)}\r\n".encode()]
+        for arg in args:
+            data = arg if isinstance(arg, bytes) else str(arg).encode()
+            parts.append(f"${len(data)}\r\n".encode() + data + b"\r\n")
+
+        return b"".join(parts)
+
+    async def read_reply(self):
+        line = await self.reader.readline()
+        if not line:
+            raise ConnectionError("Connection closed by shared state server")
+
+        prefix, rest = line[:1], line[1:-2]
+
+        if prefix == b"+":
+            return rest.decode()
+        if prefix == b"-":
+            raise StateError(rest.decode())
+        if prefix == b":":
+            return int(rest)
+        if prefix == b"$":
+            length = int(rest)
+            if length < 0:
+                return None
+            data = await self.reader.readexactly(length + 2)
+            return data[:-2].decode()
+        if prefix == b"*":
+            length = int(rest)
+            if length < 0:
+                return None
+            return [await self.read_reply() for _ in range(length)]
+
+        raise StateError(f"Unexpected reply {line!r}")
+
+    async def connect(self) -> None:
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port, ssl=self.ssl or None)
+
+        try:
+            if self.password:
+                await self.send("AUTH", self.password)
+            if self.db:
+                await self.send("SELECT", self.db)
+        except StateError:
+            # Don't keep an unauthenticated connection around for the next command
+            await self.close()
+            raise
+
+    async def send(self, *args):
+        self.writer.write(self.encode(*args))
+        await self.writer.drain()
+        return await self.read_reply()
+
+    async def execute(self, *args):
+        async with self.lock:
+            try:
+                if not self.writer:
+                    await asyncio.wait_for(self.connect(), self.timeout)
+
+                return await asyncio.wait_for(self.send(*args), self.timeout)
+            except (OSError, ConnectionError, asyncio.IncompleteReadError, asyncio.TimeoutError, asyncio.CancelledError):
+                # A reply may still be on its way; reconnect on the next command rather than read it as ours
+                await self.close()
+                raise
+
+    async def get(self, key: str):
+        return await self.execute("GET", key)
+
+    async def set(self, key: str, value: str, ttl: float = None) -> None:
+        if ttl:
+            await self.execute("SET", key, value, "PX", int(ttl * 1000))
+        else:
+            await self.execute("SET", key, value)
+
+    async def delete(self, key: str) -> None:
+        await self.execute("DEL", key)
+
+    async def hset(self, name: str, mapping: dict) -> None:
+        if mapping:
+            await self.execute("HSET", name, *[part for item in mapping.items() for part in item])
+
+    async def hget(self, name: str, field: str):
+        return await self.execute("HGET", name, field)
+
+    async def hgetall(self, name: str) -> dict:
+        reply = await self.execute("HGETALL", name) or []
+        return dict(zip(reply[::2], reply[1::2]))
+
+    async def hdel(self, name: str, *fields) -> None:
+        if fields:
+            await self.execute("HDEL", name, *fields)
+
+    async def close(self) -> None:
+        if self.writer:
+            self.writer.close()
+
+        self.reader = None
+        self.writer = None
+
+
+def get_backend(url: str = None):
+    if url and url.startswith(("redis://", "rediss://")):
+        return RedisBackend.from_url(url)
+
+    return MemoryBackend()
+
+
+class SharedState:
+    """State shared between every process running dismusic.
+
+    Holds the search cache, node load and health, and a registry of which process and node
+    plays for each guild. Configure with `bot.dismusic_state_url` or `DISMUSIC_STATE_URL`.
+    """
+
+    def __init__(self, bot, backend=None) -> None:
+        url = getattr(bot, "dismusic_state_url", None) or os.getenv("DISMUSIC_STATE_URL")
+
+        self.bot = bot
+        self.backend = backend or get_backend(url)
+        self.process_id = os.getenv("DISMUSIC_PROCESS_ID", f"{socket.gethostname()}:{os.getpid()}")
+        self.interval = float(os.getenv("DISMUSIC_STATE_SYNC_INTERVAL", 5))
+        self.search_ttl = float(os.getenv("DISMUSIC_SEARCH_CACHE_TTL", 600))
+        self.published = set()
+        self.swept_at = 0.0
+        self.stats = {"search_hits": 0, "search_misses": 0, "errors": 0}
+
+    async def call(self, method: str, *args, default=None):
+        try:
+            return await getattr(self.backend, method)(*args)
+        except (OSError, ConnectionError, asyncio.IncompleteReadError, asyncio.TimeoutError, StateError) as e:
+            self.stats["errors"] += 1
+            print(f"[dismusic] ERROR - Shared state {method} failed: {e}")
+            return default
+
+    async def get_search(self, provider: str, query: str):
+        data = await self.call("get", f"dismusic:search:{provider}:{query}")
+
+        if data is None:
+            self.stats["search_misses"] += 1
+            return None
+
+        self.stats["search_hits"] += 1
+        return [CACHEABLE_TRACKS[name](track_id, info) for name, track_id, info in json.loads(data)]
+
+    async def put_search(self, provider: str, query: str, tracks: list) -> None:
+        if not tracks or any(type(track).__name__ not in CACHEABLE_TRACKS for track in tracks):
+            return
+
+        data = json.dumps([[type(track).__name__, track.id, track.info] for track in tracks])
+        await self.call("set", f"dismusic:search:{provider}:{query}", data, self.search_ttl)
+
+    async def mark_node_down(self, node: wavelink.Node) -> None:
+        nodes.down_nodes[nodes.node_key(node)] = time.monotonic() + self.interval * 6
+        await self.call("set", f"dismusic:down:{nodes.node_key(node)}", self.process_id, self.interval * 6)
+
+    async def find_player(self, guild_id: int):
+        """Which process and node plays for a guild, if any process does"""
+        entry = await self.call("hget", "dismusic:players", str(guild_id))
+
+        if not entry:
+            return None
+
+        entry = json.loads(entry)
+        if not self.is_fresh(entry):
+            await self.call("hdel", "dismusic:players", str(guild_id))
+            return None
+
+        return entry
+
+    def is_fresh(self, entry: dict) -> bool:
+        """Entries not republished for a few intervals belong to a process that has stopped"""
+        return time.time() - entry["at"] < self.interval * 3
+
+    async def publish(self) -> None:
+        now = time.time()
+        players = {}
+
+        for node in list(wavelink.NodePool._nodes.values()):
+            load = json.dumps({"players": len(node.players), "at": now})
+            await self.call("hset", f"dismusic:load:{nodes.node_key(node)}", {self.process_id: load})
+
+            for player in node.players:
+                if isinstance(player, DisPlayer) and player.is_connected():
+                    players[str(player.guild.id)] = json.dumps(
+                        {"process": self.process_id, "node": nodes.node_key(node), "channel": player.channel.id, "at": now}
+                    )
+
+        await self.call("hset", "dismusic:players", players)
+        await self.call("hdel", "dismusic:players", *(self.published - players.keys()))
+        self.published = set(players)
+
+    async def refresh(self) -> None:
+        now = time.time()
+
+        # Every node, including ones marked down, so that the marks can clear
+        for node in list(wavelink.NodePool._nodes.values()):
+            key = nodes.node_key(node)
+            entries = await self.call("hgetall", f"dismusic:load:{key}", default={})
+
+            shared = 0
+            stale = []
+            for process, entry in entries.items():
+                entry = json.loads(entry)
+                if not self.is_fresh(entry):
+                    stale.append(process)
+                elif process != self.process_id:
+                    shared += entry["players"]
+
+            nodes.shared_load[key] = shared
+            await self.call("hdel", f"dismusic:load:{key}", *stale)
+
+            if await self.call("get", f"dismusic:down:{key}") is not None:
+                nodes.down_nodes[key] = max(nodes.down_nodes.get(key, 0), time.monotonic() + self.interval * 3)
+            elif not nodes.is_down(node):
+                nodes.down_nodes.pop(key, None)
+
+        if now - self.swept_at >= self.interval * 12:
+            await self.sweep_players()
+            self.swept_at = now
+
+    async def sweep_players(self) -> None:
+        """Remove registry entries left behind by processes that stopped without cleaning up"""
+        entries = await self.call("hgetall", "dismusic:players", default={})
+        stale = [guild for guild, entry in entries.items() if not self.is_fresh(json.loads(entry))]
+
+        await self.call("hdel", "dismusic:players", *stale)
+
+    async def run(self) -> None:
+        await self.bot.wait_until_ready()
+
+        while not self.bot.is_closed():
+            try:
+                await self.publish()
+                await self.refresh()
+            except Exception as e:
+                print(f"[dismusic] ERROR - Shared state sync failed: {e}")
+
+            await asyncio.sleep(self.interval)
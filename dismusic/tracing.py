@@ -0,0 +1,287 @@
+import asyncio
+import contextvars
+import json
+import os
+import random
+import time
+from contextlib import contextmanager
+
+import aiohttp
+
+_current_span = contextvars.ContextVar("dismusic_span", default=None)
+
+
+class Span:
+    def __init__(self, name: str, parent: "Span" = None, sampled: bool = False, **attributes) -> None:
+        self.name = name
+        self.parent = parent
+        self.trace_id = parent.trace_id if parent else os.urandom(16).hex()
+        self.span_id = os.urandom(8).hex()
+        self.sampled = parent.sampled if parent else sampled
+        self.attributes = {key: value for key, value in attributes.items() if value is not None}
+        self.children = []
+        self.error = None
+        self.start = time.time_ns()
+        self.end = None
+
+        if parent:
+            parent.children.append(self)
+
+    @property
+    def duration(self) -> float:
+        """Duration in milliseconds"""
+        return ((self.end or time.time_ns()) - self.start) / 1e6
+
+    @property
+    def active_duration(self) -> float:
+        """Duration in milliseconds, minus time spent idle (e.g. waiting for the next song)"""
+        if self.attributes.get("idle"):
+            return 0.0
+
+        return self.duration - sum(child.duration - child.active_duration for child in self.children)
+
+    def set_attribute(self, key: str, value) -> None:
+        if value is not None:
+            self.attributes[key] = value
+
+    def walk(self):
+        yield self
+        for child in self.children:
+            yield from child.walk()
+
+    def to_dict(self) -> dict:
+        return {
+            "name": self.name,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent.span_id if self.parent else None,
+            "start": self.start,
+            "end": self.end,
+            "duration_ms": round(self.duration, 3),
+            "attributes": self.attributes,
+            "error": self.error,
+        }
+
+    def format_tree(self, depth: int = 0) -> str:
+        attributes = " ".join(f"{key}={value}" for key, value in self.attributes.items())
+        line = f"{'  ' * depth}{self.name} {self.duration:.1f}ms {attributes}".rstrip()
+        if self.error:
+            line += f" error={self.error}"
+
+        return "\n".join([line] + [child.format_tree(depth + 1) for child in self.children])
+
+
+class NoopSpan:
+    def set_attribute(self, key: str, value) -> None:
+        pass
+
+
+NOOP_SPAN = NoopSpan()
+
+
+class LineWriter:
+    """Buffers lines and appends them to a file from the default executor, off the event loop"""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.buffer = []
+        self.task = None
+
+    def write(self, line: str) -> None:
+        self.buffer.append(line + "\n")
+
+        if not self.task or self.task.done():
+            self.task = asyncio.get_event_loop().create_task(self.flush())
+
+    def _append(self, lines) -> None:
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.writelines(lines)
+
+    async def flush(self) -> None:
+        while self.buffer:
+            lines, self.buffer = self.buffer, []
+            try:
+                await asyncio.get_event_loop().run_in_executor(None, self._append, lines)
+            except OSError as e:
+                print(f"[dismusic] ERROR - Failed to write {self.path}: {e}")
+
+    async def close(self) -> None:
+        if self.task:
+            await self.task
+
+        await self.flush()
+
+
+class JsonlExporter:
+    """Appends one JSON line per span to a local file"""
+
+    def __init__(self, path: str) -> None:
+        self.writer = LineWriter(path)
+
+    def export(self, root: Span) -> None:
+        for span in root.walk():
+            self.writer.write(json.dumps(span.to_dict(), ensure_ascii=False, default=str))
+
+    async def close(self) -> None:
+        await self.writer.close()
+
+
+class OtlpExporter:
+    """Posts spans to an OTLP/HTTP collector using the JSON encoding"""
+
+    def __init__(self, endpoint: str, service_name: str = "dismusic") -> None:
+        self.endpoint = endpoint.rstrip("/") + "/v1/traces"
+        self.service_name = service_name
+        self.session = None
+
+    @staticmethod
+    def encode_value(value) -> dict:
+        if isinstance(value, bool):
+            return {"boolValue": value}
+        if isinstance(value, int):
+            return {"intValue": str(value)}
+        if isinstance(value, float):
+            return {"doubleValue": value}
+
+        return {"stringValue": str(value)}
+
+    def encode_span(self, span: Span) -> dict:
+        encoded = {
+            "traceId": span.trace_id,
+            "spanId": span.span_id,
+            "name": span.name,
+            "kind": 1,
+            "startTimeUnixNano": str(span.start),
+            "endTimeUnixNano": str(span.end),
+            "attributes": [{"key": key, "value": self.encode_value(value)} for key, value in span.attributes.items()],
+            "status": {"code": 2, "message": span.error} if span.error else {"code": 1},
+        }
+        if span.parent:
+            encoded["parentSpanId"] = span.parent.span_id
+
+        return encoded
+
+    def export(self, root: Span) -> None:
+        payload = {
+            "resourceSpans": [
+                {
+                    "resource": {
+                        "attributes": [{"key": "service.name", "value": {"stringValue": self.service_name}}]
+                    },
+                    "scopeSpans": [
+                        {
+                            "scope": {"name": "dismusic"},
+                            "spans": [self.encode_span(span) for span in root.walk()],
+                        }
+                    ],
+                }
+            ]
+        }
+        asyncio.get_event_loop().create_task(self.post(payload))
+
+    async def post(self, payload: dict) -> None:
+        if not self.session:
+            self.session = aiohttp.ClientSession()
+
+        try:
+            async with self.session.post(self.endpoint, json=payload) as response:
+                if response.status >= 400:
+                    print(f"[dismusic] ERROR - OTLP exporter got HTTP {response.status}")
+        except aiohttp.ClientError as e:
+            print(f"[dismusic] ERROR - OTLP exporter failed: {e}")
+
+    async def close(self) -> None:
+        if self.session:
+            await self.session.close()
+            self.session = None
+
+
+class Tracer:
+    """Opt-in tracing of the play pipeline.
+
+    A sampled fraction of traces (`DISMUSIC_TRACE_SAMPLE_RATE`) is exported, and any trace
+    slower than `DISMUSIC_TRACE_SLOW_MS` is written to the slow request log in full.
+    """
+
+    def __init__(self, sample_rate: float = 0.0, slow_threshold: float = 0.0, exporter=None, slow_log: str = None):
+        self.sample_rate = sample_rate
+        self.slow_threshold = slow_threshold
+        self.exporter = exporter
+        self.slow_log = LineWriter(slow_log) if slow_log else None
+
+    @classmethod
+    def from_env(cls) -> "Tracer":
+        endpoint = os.getenv("DISMUSIC_TRACE_OTLP_ENDPOINT")
+
+        if endpoint:
+            exporter = OtlpExporter(endpoint)
+        else:
+            exporter = JsonlExporter(os.getenv("DISMUSIC_TRACE_FILE", "dismusic-traces.jsonl"))
+
+        return cls(
+            sample_rate=float(os.getenv("DISMUSIC_TRACE_SAMPLE_RATE", 0)),
+            slow_threshold=float(os.getenv("DISMUSIC_TRACE_SLOW_MS", 0)),
+            exporter=exporter,
+            slow_log=os.getenv("DISMUSIC_TRACE_SLOW_LOG"),
+        )
+
+    @property
+    def enabled(self) -> bool:
+        return self.sample_rate > 0 or self.slow_threshold > 0
+
+    def start_span(self, name: str, **attributes):
+        if not self.enabled:
+            return NOOP_SPAN
+
+        parent = _current_span.get()
+        span = Span(name, parent, sampled=random.random() < self.sample_rate, **attributes)
+        _current_span.set(span)
+
+        return span
+
+    def end_span(self, span, error: BaseException = None, end: int = None) -> None:
+        if not isinstance(span, Span) or span.end:
+            return
+
+        if error and not span.error:
+            span.error = f"{type(error).__name__}: {error}"
+
+        span.end = end or time.time_ns()
+
+        if _current_span.get() is span:
+            _current_span.set(span.parent)
+
+        if not span.parent:
+            self.finish(span)
+
+    @contextmanager
+    def span(self, name: str, **attributes):
+        span = self.start_span(name, **attributes)
+        try:
+            yield span
+        except BaseException as e:
+            self.end_span(span, e)
+            raise
+        else:
+            self.end_span(span)
+
+    def finish(self, root: Span) -> None:
+        if root.sampled and self.exporter:
+            self.exporter.export(root)
+
+        if self.slow_threshold and root.active_duration >= self.slow_threshold:
+            report = f"[dismusic] WARNING - Slow {root.name} ({root.active_duration:.1f}ms)\n{root.format_tree()}"
+
+            if not self.slow_log:
+                return print(report)
+
+            self.slow_log.write(json.dumps([span.to_dict() for span in root.walk()], ensure_ascii=False, default=str))
+
+    async def close(self) -> None:
+        if self.exporter:
+            await self.exporter.close()
+        if self.slow_log:
+            await self.slow_log.close()
+
+
+tracer = Tracer.from_env()